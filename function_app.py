@@ -6,29 +6,305 @@ Designed to run on Azure Container Apps with GPU workload profile.
 
 import azure.functions as func
 import logging
-import json
-import base64
+import collections
+import functools
+import gzip
+import hashlib
 import io
+import math
 import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, fields
+from typing import Optional
+
+import numpy as np
+import orjson
+import pybase64
+import torch
+from diffusers import StableDiffusionPipeline, DPMSolverMultistepScheduler
 
 app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
 
 # Global model reference for reuse across invocations
 _pipe = None
 
+# Per-worker random generator on the pipeline's device, used for unseeded requests
+_generator = None
+
+# Per-thread scratch buffer for image encoding
+_tls = threading.local()
+
+# SIMD-accelerated JPEG encoder (libjpeg-turbo); falls back to Pillow if unavailable
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    _tj = TurboJPEG()
+except Exception as e:
+    logging.warning(f"TurboJPEG not available, using Pillow for JPEG: {e}")
+    _tj = None
+
+# Quality used for lossy image encoding (JPEG and WebP)
+IMAGE_QUALITY = int(os.environ.get("IMAGE_QUALITY", 90))
+
+# UNet weight quantization: "auto" (FP8 on Hopper), "int8", "none"
+QUANTIZE = os.environ.get("QUANTIZE", "auto").lower()
+
+# Token merging (ToMe) ratio for UNet attention; unset picks 0.0 on Ampere+ and 0.5 on older GPUs
+TOME_RATIO = float(os.environ["TOME_RATIO"]) if os.environ.get("TOME_RATIO") else None
+
+# Load the model when the worker starts instead of on the first request
+PRELOAD_MODEL = os.environ.get("PRELOAD_MODEL", "1") == "1"
+
+# Compile the UNet and VAE decoder with torch.compile on GPU
+TORCH_COMPILE = os.environ.get("TORCH_COMPILE", "1") == "1"
+
+# torch.compile backend: "inductor" or "trt" (TensorRT via torch_tensorrt)
+BACKEND = os.environ.get("BACKEND", "inductor").lower()
+TRT_ENGINE_CACHE_DIR = os.environ.get("TRT_ENGINE_CACHE_DIR", "/tmp/unet_trt")
+
+# Align Your Steps (AYS) 10-step schedule for Stable Diffusion; matches
+# ~25-step DPM-Solver++ quality with 10 UNet evaluations
+AYS_TIMESTEPS = [999, 850, 736, 645, 545, 455, 343, 233, 124, 24]
+
+# Defaults used when the request doesn't specify them
+DEFAULT_NUM_STEPS = len(AYS_TIMESTEPS)
+DEFAULT_GUIDANCE_SCALE = 5.0
+
+# Upper bound on num_steps; keeps request latency and the set of compiled step counts bounded
+MAX_NUM_STEPS = 50
+
+# Fraction of denoising steps that use classifier-free guidance; the remaining
+# low-noise steps run the conditional branch only (1.0 keeps CFG for every step)
+CFG_CUTOFF = float(os.environ.get("CFG_CUTOFF", 0.7))
+
+# Coalesce concurrent requests with the same settings into one pipeline call
+# of up to BATCH_SIZE prompts, waiting at most BATCH_WINDOW_MS (1 disables batching;
+# requests still run one at a time on the pipeline worker)
+BATCH_SIZE = int(os.environ.get("BATCH_SIZE", 1))
+BATCH_WINDOW_MS = int(os.environ.get("BATCH_WINDOW_MS", 50))
+
+# Number of encoded images kept in the in-memory response cache (0 disables caching)
+CACHE_SIZE = int(os.environ.get("CACHE_SIZE", 256))
+
+# Number of text-encoder outputs cached per prompt string (each ~150 KB of GPU memory)
+PROMPT_CACHE_SIZE = int(os.environ.get("PROMPT_CACHE_SIZE", 256))
+
+# Image sizes accepted by the generator; requests are snapped to the nearest one
+# so the compiled graphs (one per shape) stay few and warm
+ALLOWED_SIZES = (512, 640, 768)
+
+
+def snap_size(value):
+    """
+    Snap a requested width/height to the nearest allowed size.
+    """
+    return min(ALLOWED_SIZES, key=lambda size: abs(size - int(value)))
+
+
+@dataclass(slots=True)
+class GenerateRequest:
+    """
+    Validated /api/generate parameters.
+    """
+    prompt: str = ""
+    negative_prompt: str = ""
+    num_steps: int = DEFAULT_NUM_STEPS
+    guidance_scale: float = DEFAULT_GUIDANCE_SCALE
+    width: int = 512
+    height: int = 512
+    seed: Optional[int] = None
+    
+    def __post_init__(self):
+        self.prompt = str(self.prompt or "")
+        self.negative_prompt = str(self.negative_prompt or "")
+        self.num_steps = min(max(int(self.num_steps), 1), MAX_NUM_STEPS)
+        self.guidance_scale = float(self.guidance_scale)
+        if not math.isfinite(self.guidance_scale):
+            raise ValueError("guidance_scale must be a finite number")
+        self.width = snap_size(self.width)
+        self.height = snap_size(self.height)
+        self.seed = int(self.seed) if self.seed is not None else None
+        if self.seed is not None and not 0 <= self.seed < 2**64:
+            raise ValueError("seed must be between 0 and 2**64 - 1")
+
+
+_GENERATE_FIELDS = frozenset(field.name for field in fields(GenerateRequest))
+
+
+def parse_generate_request(req):
+    """
+    Build a GenerateRequest from the JSON body (POST) or query string (GET).
+    Unknown keys are ignored; raises ValueError/TypeError on invalid values.
+    """
+    if req.method == "POST":
+        try:
+            data = orjson.loads(req.get_body() or b"{}")
+        except orjson.JSONDecodeError:
+            data = {}
+        if not isinstance(data, dict):
+            data = {}
+    else:
+        data = req.params
+    
+    return GenerateRequest(**{key: value for key, value in data.items() if key in _GENERATE_FIELDS})
+
+
+def encode_image(image, fmt):
+    """
+    Encode a PIL image as JPEG or WebP bytes.
+    """
+    if fmt == "jpeg" and _tj is not None:
+        return _tj.encode(np.asarray(image), quality=IMAGE_QUALITY, pixel_format=TJPF_RGB)
+
+    # Reuse this thread's buffer instead of allocating one per request
+    buffered = getattr(_tls, "buffer", None)
+    if buffered is None:
+        buffered = _tls.buffer = io.BytesIO()
+    buffered.seek(0)
+    buffered.truncate()
+
+    if fmt == "jpeg":
+        image.save(buffered, format="JPEG", quality=IMAGE_QUALITY)
+    else:
+        image.save(buffered, format="WEBP", quality=IMAGE_QUALITY, method=4)
+    return buffered.getvalue()
+
+
+def parse_accept(accept):
+    """
+    Parse an Accept header into (media_range, q) pairs.
+    """
+    ranges = []
+    for media_range in (accept or "").lower().split(","):
+        media_type, *params = [part.strip() for part in media_range.split(";")]
+        if not media_type:
+            continue
+        q = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        ranges.append((media_type, q))
+    return ranges
+
+
+def accept_quality(ranges, media_type):
+    """
+    Return (q, specificity) of the most specific Accept range matching media_type.
+    """
+    best = (0.0, -1)
+    for range_type, q in ranges:
+        if range_type == media_type:
+            specificity = 2
+        elif range_type == media_type.split("/")[0] + "/*":
+            specificity = 1
+        elif range_type == "*/*":
+            specificity = 0
+        else:
+            continue
+        if specificity > best[1]:
+            best = (q, specificity)
+    return best
+
+
+def negotiate_image_format(accept):
+    """
+    Pick a raw image format from the Accept header, or None for the JSON response.
+    Raw bytes are only returned when an image type is preferred over both
+    application/json and text/html, so browser navigations still get JSON.
+    """
+    ranges = parse_accept(accept)
+    document_q = max(accept_quality(ranges, media_type)[0] for media_type in ("application/json", "text/html"))
+    
+    # Highest q wins, then the more specific match; ties fall back to JPEG (fastest to encode)
+    q, _, fmt = max(
+        ((*accept_quality(ranges, f"image/{fmt}"), fmt) for fmt in ("jpeg", "webp")),
+        key=lambda candidate: candidate[:2]
+    )
+    return fmt if q > document_q else None
+
+
+# Encoded image bytes keyed on the request signature, least recently used first
+_cache = collections.OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def cache_key(signature):
+    """
+    Hash a request signature (a JSON-serializable dict) into a cache key.
+    """
+    return hashlib.blake2b(orjson.dumps(signature, option=orjson.OPT_SORT_KEYS), digest_size=16).digest()
+
+
+def cache_get(key):
+    """
+    Return cached image bytes for key, or None.
+    """
+    with _cache_lock:
+        data = _cache.get(key)
+        if data is not None:
+            _cache.move_to_end(key)
+        return data
+
+
+def cache_put(key, data):
+    """
+    Store image bytes, evicting the least recently used entries beyond CACHE_SIZE.
+    """
+    if CACHE_SIZE <= 0:
+        return
+    with _cache_lock:
+        _cache[key] = data
+        _cache.move_to_end(key)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+class FixedStartDPMSolverScheduler(DPMSolverMultistepScheduler):
+    """
+    DPM-Solver++ scheduler that always starts at the first timestep.
+    Without a begin index the scheduler looks up the first timestep on the GPU with
+    nonzero().item(), forcing a host-device sync at the start of every denoising loop.
+    """
+    
+    # Keep the explicit signature: diffusers inspects it to decide whether custom timesteps are supported
+    def set_timesteps(self, num_inference_steps=None, device=None, timesteps=None):
+        super().set_timesteps(num_inference_steps=num_inference_steps, device=device, timesteps=timesteps)
+        self.set_begin_index(0)
+
+
+def cfg_cutoff_callback(cutoff_step):
+    """
+    Build a step-end callback that turns off classifier-free guidance after cutoff_step.
+    Dropping the unconditional half of the prompt embeddings halves the UNet batch.
+    """
+    def callback(pipe, step_index, timestep, callback_kwargs):
+        if step_index == cutoff_step:
+            callback_kwargs["prompt_embeds"] = callback_kwargs["prompt_embeds"].chunk(2)[-1]
+            pipe._guidance_scale = 0.0
+        return callback_kwargs
+    
+    return callback
+
 
 def get_pipeline():
     """
     Lazy-load the Stable Diffusion pipeline.
     The model is loaded once and cached for subsequent requests.
     """
-    global _pipe
+    global _pipe, _generator
     
     if _pipe is None:
         logging.info("Loading Stable Diffusion model...")
         
-        import torch
-        from diffusers import StableDiffusionPipeline, DPMSolverMultistepScheduler
+        # Autotune cuDNN convolutions and allow TF32 for any float32 matmuls
+        torch.backends.cudnn.benchmark = True
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.set_float32_matmul_precision("high")
         
         model_id = os.environ.get("MODEL_ID", "stabilityai/stable-diffusion-2-1-base")
         
@@ -36,125 +312,443 @@ def get_pipeline():
         device = "cuda" if torch.cuda.is_available() else "cpu"
         logging.info(f"Using device: {device}")
         
+        # bfloat16 on Ampere+ (wider range than float16), float16 on older GPUs
+        dtype = torch.float32
+        capability = (0, 0)
         if device == "cuda":
             logging.info(f"GPU: {torch.cuda.get_device_name(0)}")
             logging.info(f"GPU Memory: {torch.cuda.get_device_properties(0).total_memory / 1024**3:.2f} GB")
+            capability = torch.cuda.get_device_capability(0)
+            dtype = torch.bfloat16 if capability >= (8, 0) else torch.float16
         
         # Load the pipeline with optimizations
-        _pipe = StableDiffusionPipeline.from_pretrained(
+        pipe = StableDiffusionPipeline.from_pretrained(
             model_id,
-            torch_dtype=torch.float16 if device == "cuda" else torch.float32,
+            torch_dtype=dtype,
             safety_checker=None,  # Disable safety checker for performance
             requires_safety_checker=False
         )
         
         # Use DPM-Solver++ for faster inference
-        _pipe.scheduler = DPMSolverMultistepScheduler.from_config(_pipe.scheduler.config)
+        pipe.scheduler = FixedStartDPMSolverScheduler.from_config(pipe.scheduler.config)
+        
+        pipe = pipe.to(device)
+        
+        # Create the generator once so requests don't allocate a new RNG state each time
+        _generator = torch.Generator(device=device)
+        _generator.seed()
+        
+        # NHWC layout lets cuDNN pick tensor-core convolution kernels
+        if device == "cuda":
+            pipe.unet.to(memory_format=torch.channels_last)
+            pipe.vae.to(memory_format=torch.channels_last)
+        
+        # Pick the fastest attention kernel: PyTorch SDPA (FlashAttention-2) on
+        # Ampere+ with PyTorch >= 2.2, otherwise xFormers, otherwise sliced attention
+        if device == "cuda":
+            if torch.__version__ >= "2.2" and capability >= (8, 0):
+                from diffusers.models.attention_processor import AttnProcessor2_0
+                for model in (pipe.unet, pipe.vae):
+                    # Fusing Q/K/V into one GEMM also installs the fused SDPA processor
+                    if hasattr(model, "fuse_qkv_projections"):
+                        model.fuse_qkv_projections()
+                    else:
+                        model.set_attn_processor(AttnProcessor2_0())
+                logging.info("PyTorch SDPA attention enabled")
+            else:
+                try:
+                    pipe.enable_xformers_memory_efficient_attention()
+                    logging.info("xFormers memory efficient attention enabled")
+                except Exception as e:
+                    logging.warning(f"xFormers not available: {e}")
+                    # Fallback to sliced attention
+                    pipe.enable_attention_slicing()
+        
+        # Quantize UNet linears (requires torchao): INT8 when requested, FP8 on Hopper
+        # torchao's quantized tensor subclasses can't be compiled by the TensorRT backend
+        use_trt = device == "cuda" and TORCH_COMPILE and BACKEND == "trt"
+        if use_trt and QUANTIZE == "int8":
+            logging.warning("QUANTIZE=int8 is ignored with BACKEND=trt")
+        
+        if device == "cuda" and QUANTIZE == "int8" and not use_trt:
+            try:
+                from torchao.quantization import quantize_, int8_weight_only, int8_dynamic_activation_int8_weight
+                # Ada+ runs INT8 x INT8 matmuls on tensor cores; older GPUs dequantize weights
+                if capability >= (8, 9):
+                    quantize_(pipe.unet, int8_dynamic_activation_int8_weight())
+                    logging.info("UNet quantized to INT8 (dynamic activation, INT8 weight)")
+                else:
+                    quantize_(pipe.unet, int8_weight_only(group_size=128))
+                    logging.info("UNet quantized to INT8 (weight only)")
+            except Exception as e:
+                logging.warning(f"INT8 quantization not available: {e}")
+        elif device == "cuda" and QUANTIZE == "auto" and capability >= (9, 0) and not use_trt:
+            try:
+                from torchao.quantization import quantize_, float8_weight_only
+                quantize_(pipe.unet, float8_weight_only())
+                logging.info("UNet quantized to FP8 (weight only)")
+            except Exception as e:
+                logging.warning(f"FP8 quantization not available: {e}")
+        
+        # Merge redundant tokens before UNet attention (requires tomesd)
+        tome_ratio = TOME_RATIO
+        if tome_ratio is None:
+            tome_ratio = 0.0 if capability >= (8, 0) else 0.5
+        if tome_ratio > 0:
+            try:
+                import tomesd
+                tomesd.apply_patch(pipe, ratio=tome_ratio, max_downsample=1)
+                logging.info(f"Token merging enabled (ratio {tome_ratio})")
+            except Exception as e:
+                logging.warning(f"Token merging not available: {e}")
         
-        _pipe = _pipe.to(device)
+        # Keep the eager modules so a failed compile can fall back to them
+        eager_unet = pipe.unet
+        eager_decode = pipe.vae.decode
+        compiled = False
         
-        # Enable memory efficient attention if available
+        # Compile the UNet and VAE decoder; reduce-overhead mode replays CUDA graphs
+        if device == "cuda" and TORCH_COMPILE:
+            try:
+                # One graph per (batch, height, width); leave room for every allowed shape
+                torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 64)
+                if BACKEND == "trt":
+                    # Build a TensorRT engine per UNet input shape, cached on disk across restarts
+                    import torch_tensorrt  # noqa: F401 - registers the torch_tensorrt backend
+                    pipe.unet = torch.compile(
+                        pipe.unet,
+                        backend="torch_tensorrt",
+                        dynamic=False,
+                        options={
+                            "enabled_precisions": {dtype},
+                            "truncate_long_and_double": True,
+                            "cache_built_engines": True,
+                            "reuse_cached_engines": True,
+                            "engine_cache_dir": TRT_ENGINE_CACHE_DIR
+                        }
+                    )
+                    logging.info("UNet compiled with TensorRT")
+                else:
+                    pipe.unet = torch.compile(pipe.unet, mode="reduce-overhead", fullgraph=False, dynamic=False)
+                    pipe.vae.decode = torch.compile(pipe.vae.decode, mode="reduce-overhead", fullgraph=False, dynamic=False)
+                    logging.info("UNet and VAE decoder compiled with torch.compile")
+                compiled = True
+            except Exception as e:
+                logging.warning(f"torch.compile not available, running eagerly: {e}")
+                pipe.unet = eager_unet
+                pipe.vae.decode = eager_decode
+        
+        # Warm up so the first real request doesn't pay for compilation, cuDNN
+        # autotuning or cuBLAS algorithm selection
         if device == "cuda":
+            logging.info("Warming up pipeline...")
             try:
-                _pipe.enable_xformers_memory_efficient_attention()
-                logging.info("xFormers memory efficient attention enabled")
+                warm_up_pipeline(pipe)
             except Exception as e:
-                logging.warning(f"xFormers not available: {e}")
-                # Fallback to sliced attention
-                _pipe.enable_attention_slicing()
+                if not compiled:
+                    raise
+                # Inductor/Triton/TensorRT errors only surface on the first call
+                logging.warning(f"Compiled pipeline failed during warm-up, falling back to eager: {e}")
+                pipe.unet = eager_unet
+                pipe.vae.decode = eager_decode
+                warm_up_pipeline(pipe)
         
+        # Publish only once fully configured and warmed up, so a failure is retried on the next call
+        _pipe = pipe
         logging.info("Model loaded successfully!")
     
     return _pipe
 
 
+@functools.lru_cache(maxsize=PROMPT_CACHE_SIZE)
+def encode_text(pipe, text):
+    """
+    Encode a prompt with the CLIP text encoder, caching the embeddings per string.
+    The empty/boilerplate negative prompt is encoded once instead of every request.
+    """
+    with torch.inference_mode():
+        prompt_embeds, _ = pipe.encode_prompt(text, pipe.device, 1, False)
+    return prompt_embeds
+
+
+def decode_latents(pipe, latents, tiled):
+    """
+    Decode latents to PIL images with the VAE.
+    Large images are decoded one at a time in tiles to cap peak memory; this is chosen
+    per call rather than via enable_tiling(), which would change the shared pipeline.
+    """
+    latents = latents / pipe.vae.config.scaling_factor
+    if tiled:
+        image = torch.cat([
+            pipe.vae.tiled_decode(latents[i:i + 1], return_dict=False)[0]
+            for i in range(latents.shape[0])
+        ])
+    else:
+        image = pipe.vae.decode(latents, return_dict=False)[0]
+    return pipe.image_processor.postprocess(image, output_type="pil")
+
+
+def warm_up_pipeline(pipe):
+    """
+    Run the default request settings twice. Goes through run_pipeline so the AYS
+    timesteps and the batch-1 CFG-cutoff graph are warmed too. CUDA graphs are
+    recorded per thread, so this must run on the pipeline worker.
+    """
+    for _ in range(2):
+        run_pipeline(pipe, ["warmup"], [""], [None], DEFAULT_NUM_STEPS, DEFAULT_GUIDANCE_SCALE, 512, 512)
+
+
+def run_pipeline(pipe, prompts, negative_prompts, seeds, num_inference_steps, guidance_scale, width, height):
+    """
+    Run the pipeline for a batch of prompts sharing the same settings.
+    A seed of None draws from the worker's generator. Returns one PIL image per prompt.
+    """
+    # Seeded requests get their own generator so the shared one is never reseeded
+    generator = [
+        _generator if seed is None else torch.Generator(device=_generator.device).manual_seed(seed)
+        for seed in seeds
+    ]
+    if len(generator) == 1:
+        generator = generator[0]
+    
+    # Use the AYS schedule when running the default number of steps
+    timesteps = AYS_TIMESTEPS if num_inference_steps == len(AYS_TIMESTEPS) else None
+    
+    # Without guidance only the conditional branch runs, so negative prompts are unused
+    callback = None
+    if guidance_scale <= 1.0:
+        guidance_scale = 0.0
+        negative_prompts = None
+    else:
+        # Skip the unconditional branch on the last low-noise steps
+        cutoff_step = int(CFG_CUTOFF * num_inference_steps) - 1
+        if 0 <= cutoff_step < num_inference_steps - 1:
+            callback = cfg_cutoff_callback(cutoff_step)
+    
+    # Pass cached text embeddings instead of raw prompts to skip the text encoder
+    prompt_embeds = torch.cat([encode_text(pipe, prompt) for prompt in prompts])
+    negative_prompt_embeds = None
+    if negative_prompts is not None:
+        negative_prompt_embeds = torch.cat([encode_text(pipe, negative_prompt or "") for negative_prompt in negative_prompts])
+    
+    with torch.inference_mode():
+        result = pipe(
+            prompt_embeds=prompt_embeds,
+            negative_prompt_embeds=negative_prompt_embeds,
+            num_inference_steps=num_inference_steps,
+            timesteps=timesteps,
+            guidance_scale=guidance_scale,
+            width=width,
+            height=height,
+            callback_on_step_end=callback,
+            callback_on_step_end_tensor_inputs=["prompt_embeds"],
+            generator=generator,
+            output_type="latent"
+        )
+        images = decode_latents(pipe, result.images, tiled=max(width, height) > 512)
+    
+    return images
+
+
+# Pending (prompt, negative_prompt, seed, settings, future) entries for the pipeline worker.
+# All pipeline calls run on this single thread: the pipeline, its scheduler and the CFG
+# cutoff callback all mutate shared state, so concurrent calls would corrupt each other.
+_batch_queue = queue.Queue()
+_batch_worker = None
+_batch_lock = threading.Lock()
+
+
+def start_batch_worker():
+    """
+    Start the pipeline worker thread if it isn't running yet.
+    """
+    global _batch_worker
+    
+    with _batch_lock:
+        if _batch_worker is None:
+            _batch_worker = threading.Thread(target=batch_loop, name="batch-worker", daemon=True)
+            _batch_worker.start()
+
+
+def submit_to_batch(prompt, negative_prompt, seed, settings):
+    """
+    Queue a prompt for the pipeline worker and return a Future for its image.
+    """
+    start_batch_worker()
+    
+    future = Future()
+    _batch_queue.put((prompt, negative_prompt, seed, settings, future))
+    return future
+
+
+def batch_loop():
+    """
+    Drain the queue into batches of requests with matching settings and run them
+    one batch at a time. Requests with other settings are held back for the next batch.
+    """
+    # Load and warm the model here so CUDA graphs are recorded on the thread that replays them;
+    # on failure the first request retries
+    if PRELOAD_MODEL:
+        try:
+            get_pipeline()
+        except Exception as e:
+            logging.error(f"Error preloading model: {str(e)}")
+    
+    held = []
+    
+    while True:
+        first = held.pop(0) if held else _batch_queue.get()
+        batch = [first]
+        
+        # Pick up matching requests already held back, then wait out the window
+        for item in list(held):
+            if len(batch) < BATCH_SIZE and item[3] == first[3]:
+                held.remove(item)
+                batch.append(item)
+        
+        deadline = time.monotonic() + BATCH_WINDOW_MS / 1000
+        while len(batch) < BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = _batch_queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item[3] == first[3]:
+                batch.append(item)
+            else:
+                held.append(item)
+        
+        prompts = [item[0] for item in batch]
+        negative_prompts = [item[1] for item in batch]
+        seeds = [item[2] for item in batch]
+        futures = [item[4] for item in batch]
+        
+        logging.info(f"Running batch of {len(batch)} prompt(s)")
+        
+        try:
+            images = run_pipeline(get_pipeline(), prompts, negative_prompts, seeds, *first[3])
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            continue
+        
+        for future, image in zip(futures, images):
+            future.set_result(image)
+
+
+# Start loading the model as soon as the Functions worker imports this module
+if PRELOAD_MODEL:
+    start_batch_worker()
+
+
 @app.route(route="generate", methods=["POST", "GET"])
 def generate_image(req: func.HttpRequest) -> func.HttpResponse:
     """
     HTTP trigger function to generate images from text prompts.
     
     POST /api/generate
-    Body: {"prompt": "your text prompt", "negative_prompt": "optional", "num_steps": 25, "guidance_scale": 7.5}
+    Body: {"prompt": "your text prompt", "negative_prompt": "optional", "num_steps": 10, "guidance_scale": 5.0, "seed": 42}
     
     GET /api/generate?prompt=your+text+prompt
     
-    Returns: JSON with base64-encoded image
+    Returns: raw image bytes if the Accept header asks for image/webp, image/jpeg
+    or image/*; otherwise JSON with a base64-encoded WebP image
     """
     logging.info('Image generation request received.')
     
     try:
         # Parse request parameters
-        if req.method == "POST":
-            try:
-                req_body = req.get_json()
-            except ValueError:
-                req_body = {}
-            
-            prompt = req_body.get('prompt', '')
-            negative_prompt = req_body.get('negative_prompt', '')
-            num_inference_steps = req_body.get('num_steps', 25)
-            guidance_scale = req_body.get('guidance_scale', 7.5)
-            width = req_body.get('width', 512)
-            height = req_body.get('height', 512)
-        else:
-            prompt = req.params.get('prompt', '')
-            negative_prompt = req.params.get('negative_prompt', '')
-            num_inference_steps = int(req.params.get('num_steps', 25))
-            guidance_scale = float(req.params.get('guidance_scale', 7.5))
-            width = int(req.params.get('width', 512))
-            height = int(req.params.get('height', 512))
+        try:
+            params = parse_generate_request(req)
+        except (TypeError, ValueError) as e:
+            return func.HttpResponse(
+                orjson.dumps({"error": f"Invalid parameter: {e}"}),
+                status_code=400,
+                mimetype="application/json"
+            )
+        
+        prompt = params.prompt
+        negative_prompt = params.negative_prompt
+        num_inference_steps = params.num_steps
+        guidance_scale = params.guidance_scale
+        width = params.width
+        height = params.height
+        seed = params.seed
         
         if not prompt:
             return func.HttpResponse(
-                json.dumps({"error": "Please provide a 'prompt' parameter"}),
+                orjson.dumps({"error": "Please provide a 'prompt' parameter"}),
                 status_code=400,
                 mimetype="application/json"
             )
         
         logging.info(f"Generating image for prompt: {prompt[:100]}...")
         
-        # Get the pipeline and generate image
-        pipe = get_pipeline()
+        # Return raw image bytes when the client accepts them, otherwise JSON with WebP
+        image_format = negotiate_image_format(req.headers.get("Accept"))
+        encoding = image_format or "webp"
         
-        import torch
-        
-        # Generate the image
-        with torch.inference_mode():
-            result = pipe(
-                prompt=prompt,
-                negative_prompt=negative_prompt if negative_prompt else None,
-                num_inference_steps=num_inference_steps,
-                guidance_scale=guidance_scale,
-                width=width,
-                height=height
-            )
+        # Serve repeated seeded requests from the cache; unseeded requests should
+        # produce a new image every time, so they bypass it
+        key = None
+        image_bytes = None
+        cache_status = "BYPASS"
+        if seed is not None:
+            key = cache_key({
+                "prompt": prompt,
+                "negative_prompt": negative_prompt,
+                "num_steps": num_inference_steps,
+                "guidance_scale": guidance_scale,
+                "width": width,
+                "height": height,
+                "seed": seed,
+                "format": encoding
+            })
+            image_bytes = cache_get(key)
+            cache_status = "HIT" if image_bytes is not None else "MISS"
         
-        image = result.images[0]
+        if image_bytes is None:
+            # Generate the image on the pipeline worker, batched with concurrent requests when enabled
+            settings = (num_inference_steps, guidance_scale, width, height)
+            image = submit_to_batch(prompt, negative_prompt, seed, settings).result()
+            
+            logging.info("Image generated successfully!")
+            
+            image_bytes = encode_image(image, encoding)
+            if key is not None:
+                cache_put(key, image_bytes)
         
-        # Convert to base64
-        buffered = io.BytesIO()
-        image.save(buffered, format="PNG")
-        img_str = base64.b64encode(buffered.getvalue()).decode()
+        if image_format:
+            return func.HttpResponse(
+                image_bytes,
+                status_code=200,
+                mimetype=f"image/{image_format}",
+                headers={"X-Cache": cache_status, "Vary": "Accept"}
+            )
         
-        logging.info("Image generated successfully!")
+        # Otherwise convert to base64 for the JSON response
+        img_str = pybase64.b64encode(image_bytes).decode()
         
         return func.HttpResponse(
-            json.dumps({
+            orjson.dumps({
                 "success": True,
                 "prompt": prompt,
                 "image": img_str,
-                "format": "png",
+                "format": "webp",
                 "width": width,
                 "height": height
             }),
             status_code=200,
-            mimetype="application/json"
+            mimetype="application/json",
+            headers={"X-Cache": cache_status, "Vary": "Accept"}
         )
         
     except Exception as e:
         logging.error(f"Error generating image: {str(e)}")
         return func.HttpResponse(
-            json.dumps({"error": str(e)}),
+            orjson.dumps({"error": str(e)}),
             status_code=500,
             mimetype="application/json"
         )
@@ -165,8 +759,6 @@ def health_check(req: func.HttpRequest) -> func.HttpResponse:
     """
     Health check endpoint to verify the function is running.
     """
-    import torch
-    
     gpu_available = torch.cuda.is_available()
     gpu_info = {}
     
@@ -179,7 +771,7 @@ def health_check(req: func.HttpRequest) -> func.HttpResponse:
         }
     
     return func.HttpResponse(
-        json.dumps({
+        orjson.dumps({
             "status": "healthy",
             "gpu_available": gpu_available,
             "gpu_info": gpu_info,
@@ -190,12 +782,8 @@ def health_check(req: func.HttpRequest) -> func.HttpResponse:
     )
 
 
-@app.route(route="", methods=["GET"])
-def index(req: func.HttpRequest) -> func.HttpResponse:
-    """
-    Root endpoint - returns a simple HTML page with usage instructions.
-    """
-    html_content = """
+# Static web UI, gzip-compressed once at import time
+INDEX_HTML = """
     <!DOCTYPE html>
     <html>
     <head>
@@ -260,7 +848,7 @@ curl -X POST {BASE_URL}/api/generate \\
                     const data = await response.json();
                     
                     if (data.success) {
-                        result.innerHTML = '<h3>Generated Image:</h3><img id="generatedImage" src="data:image/png;base64,' + data.image + '" />';
+                        result.innerHTML = '<h3>Generated Image:</h3><img id="generatedImage" src="data:image/' + data.format + ';base64,' + data.image + '" />';
                     } else {
                         result.innerHTML = '<p style="color:red;">Error: ' + data.error + '</p>';
                     }
@@ -274,4 +862,15 @@ curl -X POST {BASE_URL}/api/generate \\
     </body>
     </html>
     """
-    return func.HttpResponse(html_content, mimetype="text/html")
+INDEX_HTML_GZ = gzip.compress(INDEX_HTML.encode("utf-8"), compresslevel=9)
+
+
+@app.route(route="", methods=["GET"])
+def index(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Root endpoint - returns a simple HTML page with usage instructions.
+    """
+    headers = {"Cache-Control": "public, max-age=3600", "Vary": "Accept-Encoding"}
+    if "gzip" in req.headers.get("Accept-Encoding", ""):
+        return func.HttpResponse(INDEX_HTML_GZ, mimetype="text/html", headers={**headers, "Content-Encoding": "gzip"})
+    return func.HttpResponse(INDEX_HTML, mimetype="text/html", headers=headers)